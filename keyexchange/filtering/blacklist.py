@@ -49,6 +49,65 @@ Blacklisted IPs are kept in memory with a TTL.
 """
 import time
 import threading
+import heapq
+import random
+from collections import deque
+
+# the blacklist is stored in memcached under _KEY, serialized by _dumps.
+# Older versions pickled an (ips, ttls) tuple under _OLD_KEY, which is
+# still read when _KEY is missing but never written, so old and new
+# apps can run side by side during an upgrade.
+_KEY = 'keyexchange:blacklist:v2'
+_OLD_KEY = 'keyexchange:blacklist'
+
+# the blacklist is compressed by the memcached client beyond that size
+_MIN_COMPRESS_LEN = 1024
+
+# save() can run in a request, so its retries must stay short: at worst
+# it waits 0.005 * (1 + 2 + 4 + 8) = 75ms before giving up, and the next
+# sync tries again.
+_SAVE_TRIES = 5
+_SAVE_BACKOFF = 0.005
+
+# expiration date used in lookups for the IPs without TTL
+_NEVER = float('inf')
+
+
+def _dumps(ttls):
+    """Serializes the blacklist as one "ip expiry" line per IP.
+
+    This is smaller and faster to load than a pickle. IPs come from the
+    request headers, so they are escaped to never contain a newline.
+    """
+    lines = []
+    for ip, expiry in ttls.iteritems():
+        ip = ip.encode('string_escape')
+        if expiry is None:
+            lines.append('%s -' % ip)
+        else:
+            lines.append('%s %r' % (ip, expiry))
+    return '\n'.join(lines)
+
+
+def _loads(data):
+    """Loads a blacklist serialized with _dumps. Returns (ips, ttls)."""
+    if data is None:
+        return None
+    ttls = {}
+    if data:
+        for line in data.split('\n'):
+            try:
+                ip, expiry = line.rsplit(' ', 1)
+                ip = ip.decode('string_escape')
+                if expiry == '-':
+                    expiry = None
+                else:
+                    expiry = float(expiry)
+            except ValueError:
+                # a bad line should not make the whole blacklist unusable
+                continue
+            ttls[ip] = expiry
+    return set(ttls), ttls
 
 
 class _Syncer(threading.Thread):
@@ -57,14 +116,19 @@ class _Syncer(threading.Thread):
         threading.Thread.__init__(self)
         self.blacklist = blacklist
         self.frequency = frequency
+        # minimum time between two saves, so changes made in a burst
+        # are saved together
+        self.save_interval = frequency / 5.
         self.running = False
 
     def run(self):
         self.running = True
+        last_save = 0
         while self.running:
             # this syncs the blacklist
             try:
                 if self.blacklist.outsynced:
+                    last_save = time.time()
                     self.blacklist.save()
                 else:
                     self.blacklist.update()
@@ -74,12 +138,18 @@ class _Syncer(threading.Thread):
                 from keyexchange.filtering import logger
                 logger.error(str(e))
 
-            time.sleep(self.frequency)
+            # waiting for the next change, or for the next update
+            self.blacklist._dirty_event.wait(self.frequency)
+            delay = last_save + self.save_interval - time.time()
+            if delay > 0 and self.running:
+                time.sleep(delay)
+            self.blacklist._dirty_event.clear()
 
     def join(self):
         if not self.running:
             return
         self.running = False
+        self.blacklist._dirty_event.set()
         threading.Thread.join(self)
 
 
@@ -88,13 +158,38 @@ class Blacklist(object):
 
     IPs are saved/loaded from Memcached so several apps can share the
     blacklist.
+
+    IPs are kept as the strings found in the request. They can be IPv4,
+    IPv6 or whatever a client sent in X-Forwarded-For, so they are not
+    converted to a numeric form.
+
+    Lookups don't take the lock: writers publish a snapshot mapping each
+    IP to its expiration date, that readers use as-is.
+
+    Expiration dates are also kept in a heap, so finding the expired IPs
+    does not require a scan of the whole blacklist.
+
+    If max_size is given, the oldest IPs are dropped when the blacklist
+    grows bigger. An IP blacklisted again counts as a new one.
     """
-    def __init__(self, cache_server=None, frequency=5, async=True):
+    def __init__(self, cache_server=None, frequency=5, async=True,
+                 max_size=None):
         self._ttls = {}
+        self._expiry_heap = []
+        self._removed = set()
+        self._generation = 0
         self._cache_server = cache_server
         self.ips = set()
+        self._snapshot = {}
+        self.max_size = max_size
+        # insertion order, only kept when there's a max_size
+        self._order = deque()
+        self._added = {}
+        self._seq = 0
         self._dirty = False
-        self._lock = threading.RLock()
+        self._dirty_event = threading.Event()
+        self._lock = threading.Lock()
+        self._save_lock = threading.Lock()
         self.async = async
         if self.async:
             self._syncer = _Syncer(self, frequency=frequency)
@@ -104,14 +199,18 @@ class Blacklist(object):
     def __getstate__(self):
         odict = self.__dict__.copy()
         del odict['_lock']
+        del odict['_save_lock']
+        del odict['_dirty_event']
         if self.async:
             del odict['_syncer']
         return odict
 
     def __setstate__(self, state):
         self.__dict__.update(state)
+        self._dirty_event = threading.Event()
+        self._save_lock = threading.Lock()
         if self.async:
-            self._lock = threading.RLock()
+            self._lock = threading.Lock()
 
     def _get_dirty(self):
         # hiding it behind a property since
@@ -120,52 +219,189 @@ class Blacklist(object):
 
     outsynced = property(_get_dirty)
 
+    def _publish(self):
+        # must be called with the lock held.
+        # the snapshot is never modified once published
+        snapshot = {}
+        for ip, expiry in self._ttls.iteritems():
+            if expiry is None:
+                expiry = _NEVER
+            snapshot[ip] = expiry
+        self._snapshot = snapshot
+
+    def _track(self, ip):
+        # must be called with the lock held.
+        if self.max_size is None:
+            return
+        self._seq += 1
+        self._added[ip] = self._seq
+        self._order.append((self._seq, ip))
+        if len(self._order) > 2 * self.max_size:
+            # dropping the entries of IPs removed or added again since
+            self._order = deque([(seq, ip) for seq, ip in self._order
+                                 if self._added.get(ip) == seq])
+
+    def _trim(self, room=0):
+        # must be called with the lock held.
+        # drops the oldest IPs until there's room for `room` new ones
+        if self.max_size is None:
+            return
+        while len(self.ips) + room > self.max_size and self._order:
+            seq, ip = self._order.popleft()
+            if self._added.get(ip) != seq:
+                continue
+            self.ips.discard(ip)
+            del self._ttls[ip]
+            del self._added[ip]
+            # so it's not merged back, and gets removed from memcached
+            self._removed.add(ip)
+            self._dirty = True
+
     def update(self):
-        """Loads the IP list from memcached."""
+        """Loads the IP list from memcached, and drops the expired IPs."""
+        self._sweep_expired()
         if self._cache_server is None:
             return
+        # memcached is queried without holding the lock
+        generation = self._generation
+        data = self._fetch()[0]
         self._lock.acquire()
         try:
-            self._update()
+            # if a save went through meanwhile, data is outdated
+            if generation == self._generation:
+                self._merge(data)
         finally:
             self._lock.release()
 
-    def _update(self):
-        data = self._cache_server.get('keyexchange:blacklist')
-        # merging the memcached values
+    def _fetch(self):
+        # returns the memcached blacklist as (ips, ttls) or None, and
+        # whether it was read from the key of older versions
+        data = _loads(self._cache_server.gets(_KEY))
         if data is not None:
-            ips, ttls = data
-            # get new blacklisted IP
-            if not self.ips.issuperset(ips):
-                self.ips.union(ips)
-                self._ttls.update(ttls)
+            return data, False
+        # python-memcached keeps the CAS id of the last hit, and would
+        # use it for a key that is gone, making every cas() fail.
+        getattr(self._cache_server, 'cas_ids', {}).pop(_KEY, None)
+        return self._cache_server.get(_OLD_KEY), True
+
+    def _merge(self, data):
+        # merging the memcached values
+        if data is None:
+            return
+        ips, ttls = data
+        # IPs removed here since the last save are not merged back,
+        # and neither are the expired ones
+        now = time.time()
+        new_ips = [ip for ip in ips if ip not in self.ips and
+                   ip not in self._removed and
+                   (ttls.get(ip) is None or ttls[ip] > now)]
+        if not new_ips:
+            return
+        self.ips.update(new_ips)
+        for ip in new_ips:
+            expiry = ttls.get(ip)
+            self._ttls[ip] = expiry
+            if expiry is not None:
+                heapq.heappush(self._expiry_heap, (expiry, ip))
+            self._track(ip)
+        self._trim()
+        self._publish()
 
     def save(self):
-        """Save the IP into memcached if needed."""
+        """Drops the expired IPs, and saves the IPs into memcached if
+        needed."""
+        self._sweep_expired()
         if self._cache_server is None or not self._dirty:
             return
 
+        # one save at a time, so pushes don't land out of order
+        self._save_lock.acquire()
+        try:
+            self._save()
+        finally:
+            self._save_lock.release()
+
+    def _save(self):
+        for tries in range(_SAVE_TRIES):
+            remote, from_old_key = self._fetch()
+            self._lock.acquire()
+            try:
+                self._merge(remote)
+                # changes made from now on will need another save
+                self._dirty = False
+                # _ttls has an entry for every IP
+                if (remote is not None and not from_old_key and
+                    remote[1] == self._ttls):
+                    # memcached already holds the same blacklist
+                    self._removed.clear()
+                    return
+                ttls = dict(self._ttls)
+                removed = set(self._removed)
+            finally:
+                self._lock.release()
+
+            data = _dumps(ttls)
+            if self._cache_server.cas(_KEY, data,
+                                      min_compress_len=_MIN_COMPRESS_LEN):
+                self._lock.acquire()
+                try:
+                    # the removed IPs are gone from memcached, and any
+                    # data fetched before this point is outdated
+                    self._removed.difference_update(removed)
+                    self._generation += 1
+                finally:
+                    self._lock.release()
+                return
+
+            # another app changed the blacklist in the meantime.
+            # waiting a random time so the apps don't retry together
+            self._dirty = True
+            if tries < _SAVE_TRIES - 1:
+                time.sleep(random.uniform(0, _SAVE_BACKOFF * 2 ** tries))
+
+        from keyexchange.filtering import logger
+        logger.error('Could not update the backlist')
+
+    def _sweep_expired(self):
+        """Removes all the expired IPs."""
         self._lock.acquire()
         try:
-            # XXX will use CAS/GETS once pylibmc 1.1.2 is released
-            self._update()
-            data = self.ips, self._ttls
-            if not self._cache_server.set('keyexchange:blacklist', data):
-                from keyexchange.filtering import logger
-                logger.error('Could not update the backlist')
-            self._dirty = False
+            now = time.time()
+            heap = self._expiry_heap
+            swept = False
+            while heap and heap[0][0] <= now:
+                expiry, ip = heapq.heappop(heap)
+                # the IP was removed or blacklisted again since
+                if self._ttls.get(ip) != expiry:
+                    continue
+                self.ips.discard(ip)
+                del self._ttls[ip]
+                self._added.pop(ip, None)
+                swept = True
+            if swept:
+                self._publish()
+                self._dirty = True
         finally:
             self._lock.release()
 
     def add(self, elmt, ttl=None):
         self._lock.acquire()
         try:
+            if elmt not in self.ips:
+                # making room first, so the new IP is never dropped
+                self._trim(room=1)
             self.ips.add(elmt)
+            self._removed.discard(elmt)
             if ttl is not None:
-                self._ttls[elmt] = time.time() + ttl
+                expiry = time.time() + ttl
+                self._ttls[elmt] = expiry
+                heapq.heappush(self._expiry_heap, (expiry, elmt))
             else:
                 self._ttls[elmt] = None
+            self._track(elmt)
+            self._publish()
             self._dirty = True
+            self._dirty_event.set()
         finally:
             self._lock.release()
 
@@ -174,26 +410,21 @@ class Blacklist(object):
         try:
             self.ips.remove(elmt)
             del self._ttls[elmt]
+            self._added.pop(elmt, None)
+            self._removed.add(elmt)
+            self._publish()
             self._dirty = True
+            self._dirty_event.set()
         finally:
             self._lock.release()
 
     def __contains__(self, elmt):
-        self._lock.acquire()
-        try:
-            found = elmt in self.ips
-            if found:
-                ttl = self._ttls[elmt]
-                if ttl is None:
-                    return True
-                if self._ttls[elmt] - time.time() <= 0:
-                    # this will not provocate a deadlock
-                    # since we use a Re-entrant lock.
-                    self.remove(elmt)
-                    return False
-            return found
-        finally:
-            self._lock.release()
+        # most IPs are not blacklisted, so a miss costs a single lookup.
+        # expired IPs are removed on save() or update()
+        snapshot = self._snapshot
+        if elmt not in snapshot:
+            return False
+        return snapshot[elmt] > time.time()
 
     def __len__(self):
         return len(self.ips)
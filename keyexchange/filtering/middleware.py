@@ -67,7 +67,7 @@ class IPFiltering(object):
                  admin_page=None, use_memory=False, refresh_frequency=1,
                  observe=False, callback=None, ip_whitelist=None,
                  async=True, update_blfreq=None, ip_queue_ttl=360,
-                 br_callback=None):
+                 br_callback=None, blacklist_size=None):
 
         """Initializes the middleware.
 
@@ -96,6 +96,8 @@ class IPFiltering(object):
         - update_blfreq: number of requests before the blacklist is updated.
           async must be False.
         - ip_queue_ttl: Maximum time to live for an IP in the queues.
+        - blacklist_size: Maximum number of IPs in the blacklist. When it's
+          reached, the oldest IPs are dropped. Defaults to None (no limit).
         """
         self.app = app
         self.blacklist_ttl = blacklist_ttl
@@ -109,14 +111,15 @@ class IPFiltering(object):
         self._last_br_ips = IPQueue(br_queue_size, ttl=ip_queue_ttl)
         if isinstance(cache_servers, str):
             cache_servers = [cache_servers]
-        self._cache_server = get_memcache_class(use_memory)(cache_servers)
+        self._cache_server = get_memcache_class(use_memory)(cache_servers,
+                                                            cache_cas=True)
         self.async = async
         if self.async and update_blfreq is not None:
             raise ValueError('Cannot use async mode with update_blfreq')
         self.update_blfreq = update_blfreq
         self._blcounter = 0
         self._blacklisted = Blacklist(self._cache_server, refresh_frequency,
-                                      self.async)
+                                      self.async, blacklist_size)
         if admin_page is not None and not admin_page.startswith('/'):
             admin_page = '/' + admin_page
         self.admin_page = admin_page
@@ -40,7 +40,7 @@ import random
 import cPickle
 
 from keyexchange.filtering.middleware import IPFiltering
-from keyexchange.filtering.blacklist import Blacklist
+from keyexchange.filtering.blacklist import Blacklist, _dumps, _loads
 from keyexchange.filtering.ipqueue import IPQueue
 from keyexchange.util import MemoryClient
 
@@ -60,6 +60,29 @@ class FakeApp(object):
             return ['something', 'valid']
 
 
+class CASClient(MemoryClient):
+    """Implements CAS like python-memcached does with cache_cas=True."""
+    def __init__(self, servers, **kw):
+        self.cas_ids = {}
+        self._versions = {}
+
+    def set(self, key, value, time=0, min_compress_len=0):
+        self._versions[key] = self._versions.get(key, 0) + 1
+        return MemoryClient.set(self, key, value)
+
+    def gets(self, key):
+        if key in self:
+            self.cas_ids[key] = self._versions[key]
+        return self.get(key)
+
+    def cas(self, key, value, time=0, min_compress_len=0):
+        if key not in self.cas_ids:
+            return self.set(key, value)
+        if key not in self or self._versions[key] != self.cas_ids[key]:
+            return False
+        return self.set(key, value)
+
+
 class TestIPFiltering(unittest.TestCase):
 
     def setUp(self):
@@ -279,6 +302,273 @@ class TestIPFiltering(unittest.TestCase):
         # make sure the logging happens and the thread does not die
         time.sleep(0.5)
 
+    def test_blacklist_save_retries(self):
+        # when the CAS fails, save() tries again
+        class FailingClient(MemoryClient):
+            failures = 3
+
+            def cas(self, key, value, **kw):
+                if self.failures > 0:
+                    self.failures -= 1
+                    return False
+                return self.set(key, value, **kw)
+
+        cache = FailingClient(None)
+        blacklist = Blacklist(cache, async=False)
+        blacklist.add('one')
+        blacklist.save()
+        self.assertEqual(cache.failures, 0)
+        self.assertFalse(blacklist._dirty)
+        ips, ttls = _loads(cache['keyexchange:blacklist:v2'])
+        self.assertEqual(ips, set(['one']))
+
+    def test_blacklist_save_gives_up(self):
+        # save() may run in a request, so it does not retry for long
+        class ConflictClient(MemoryClient):
+            def cas(self, key, value, **kw):
+                return False
+
+        blacklist = Blacklist(ConflictClient(None), async=False)
+        blacklist.add('one')
+        start = time.time()
+        blacklist.save()
+        self.assertTrue(time.time() - start < .2)
+        # the next sync will try again
+        self.assertTrue(blacklist._dirty)
+
+    def test_blacklist_save_flushed(self):
+        # the blacklist can still be saved after memcached lost it
+        cache = CASClient(None)
+        blacklist = Blacklist(cache, async=False)
+        blacklist.add('one')
+        blacklist.save()
+        blacklist.add('two')
+        blacklist.save()
+        cache.clear()
+        blacklist.add('three')
+        blacklist.save()
+        self.assertFalse(blacklist._dirty)
+        ips, ttls = _loads(cache['keyexchange:blacklist:v2'])
+        self.assertEqual(ips, set(['one', 'two', 'three']))
+
+    def test_blacklist_shared(self):
+        # two blacklists sharing the same memcached
+        cache = MemoryClient(None)
+        blacklist = Blacklist(cache, async=False)
+        blacklist2 = Blacklist(cache, async=False)
+        blacklist.add('one')
+        blacklist.add('two', 10)
+        blacklist.add('three', .1)
+        blacklist.save()
+        time.sleep(.2)
+
+        blacklist2.update()
+        self.assertTrue('one' in blacklist2)
+        self.assertTrue('two' in blacklist2)
+        self.assertEqual(len(blacklist2), 2)
+
+        # a removed IP does not come back from memcached
+        blacklist2.remove('one')
+        blacklist2.save()
+        blacklist.remove('one')
+        blacklist.update()
+        self.assertFalse('one' in blacklist)
+        ips, ttls = _loads(cache['keyexchange:blacklist:v2'])
+        self.assertEqual(ips, set(['two']))
+
+    def test_blacklist_syncer_wakes_up(self):
+        # changes are saved right away, not at the next refresh
+        cache = MemoryClient(None)
+        blacklist = Blacklist(cache, frequency=10)
+        try:
+            blacklist.add('one')
+            time.sleep(.2)
+            self.assertFalse(blacklist._dirty)
+            ips, ttls = _loads(cache['keyexchange:blacklist:v2'])
+            self.assertEqual(ips, set(['one']))
+        finally:
+            blacklist._syncer.join()
+
+    def test_blacklist_save_unchanged(self):
+        # saving the same content twice only hits memcached once
+        class CountingClient(MemoryClient):
+            calls = 0
+
+            def cas(self, key, value, **kw):
+                self.calls += 1
+                return self.set(key, value, **kw)
+
+        cache = CountingClient(None)
+        blacklist = Blacklist(cache, async=False)
+        blacklist.add('one')
+        blacklist.save()
+        self.assertEqual(cache.calls, 1)
+
+        blacklist.add('two')
+        blacklist.remove('two')
+        self.assertTrue(blacklist._dirty)
+        blacklist.save()
+        self.assertEqual(cache.calls, 1)
+        self.assertFalse(blacklist._dirty)
+
+        blacklist.add('two')
+        blacklist.save()
+        self.assertEqual(cache.calls, 2)
+
+        # the blacklist is pushed again if memcached lost it
+        cache.clear()
+        blacklist.add('three')
+        blacklist.remove('three')
+        blacklist.save()
+        self.assertEqual(cache.calls, 3)
+        self.assertFalse(blacklist._dirty)
+        ips, ttls = _loads(cache['keyexchange:blacklist:v2'])
+        self.assertEqual(ips, set(['one', 'two']))
+
+    def test_blacklist_max_size(self):
+        # when full, the oldest IPs are dropped, whatever their TTL
+        blacklist = Blacklist(MemoryClient(None), async=False, max_size=2)
+        blacklist.add('br1', 3600)
+        blacklist.add('br2', 3600)
+        blacklist.add('attacker', 600)
+        self.assertEqual(len(blacklist), 2)
+        self.assertTrue('attacker' in blacklist)
+        self.assertFalse('br1' in blacklist)
+
+        # blacklisting an IP again makes it the newest one
+        blacklist.add('br2', 3600)
+        blacklist.add('forever')
+        self.assertEqual(blacklist.ips, set(['br2', 'forever']))
+
+        # removed IPs don't count
+        blacklist.remove('br2')
+        blacklist.add('attacker2', 600)
+        self.assertEqual(blacklist.ips, set(['forever', 'attacker2']))
+
+        # dropped IPs are not merged back from memcached
+        cache = MemoryClient(None)
+        blacklist = Blacklist(cache, async=False, max_size=2)
+        blacklist.add('one')
+        blacklist.add('two')
+        blacklist.save()
+        blacklist.add('three')
+        blacklist.save()
+        self.assertEqual(blacklist.ips, set(['two', 'three']))
+        ips, ttls = _loads(cache['keyexchange:blacklist:v2'])
+        self.assertEqual(ips, set(['two', 'three']))
+
+    def test_blacklist_serialization(self):
+        ttls = {'10.0.0.1': None, '2001:db8::1': time.time() + 10,
+                'some thing': 12.5, '1.2.3.4\n 5.6.7.8': 10.,
+                'back\\slash': None}
+        ips, loaded = _loads(_dumps(ttls))
+        self.assertEqual(ips, set(ttls))
+        self.assertEqual(loaded, ttls)
+        self.assertEqual(_loads(_dumps({})), (set(), {}))
+
+        # bad lines are skipped
+        ips, loaded = _loads('1.2.3.4 -\nbad\n5.6.7.8 nan?\n::1 12.5')
+        self.assertEqual(loaded, {'1.2.3.4': None, '::1': 12.5})
+
+        # an IP with a newline does not break the shared blacklist
+        cache = MemoryClient(None)
+        blacklist = Blacklist(cache, async=False)
+        blacklist.add('1.2.3.4\n 5.6.7.8', 600)
+        blacklist.save()
+        blacklist.add('x', 600)
+        blacklist.save()
+        blacklist2 = Blacklist(cache, async=False)
+        blacklist2.update()
+        self.assertTrue('1.2.3.4\n 5.6.7.8' in blacklist2)
+        self.assertTrue('x' in blacklist2)
+
+        # blacklists pickled by older versions are still loaded, but
+        # never overwritten, since older versions can't read the new format
+        cache = MemoryClient(None)
+        old = (set(['one']), {'one': None})
+        cache.set('keyexchange:blacklist', old)
+        blacklist = Blacklist(cache, async=False)
+        blacklist.update()
+        self.assertTrue('one' in blacklist)
+        blacklist.add('two')
+        blacklist.save()
+        self.assertEqual(cache['keyexchange:blacklist'], old)
+        ips, ttls = _loads(cache['keyexchange:blacklist:v2'])
+        self.assertEqual(ips, set(['one', 'two']))
+
+    def test_blacklist_syncer_batches(self):
+        # changes made right after a save are saved together
+        class CountingClient(MemoryClient):
+            calls = 0
+
+            def cas(self, key, value, **kw):
+                self.calls += 1
+                return self.set(key, value, **kw)
+
+        cache = CountingClient(None)
+        blacklist = Blacklist(cache, frequency=5)
+        try:
+            blacklist.add('one')
+            time.sleep(.2)
+            self.assertEqual(cache.calls, 1)
+            blacklist.add('two')
+            blacklist.add('three')
+            time.sleep(.2)
+            self.assertEqual(cache.calls, 1)
+            time.sleep(1.)
+            self.assertEqual(cache.calls, 2)
+            ips, ttls = _loads(cache['keyexchange:blacklist:v2'])
+            self.assertEqual(ips, set(['one', 'two', 'three']))
+        finally:
+            blacklist._syncer.join()
+
+    def test_blacklist_sweep(self):
+        # expired IPs are not found anymore, and get dropped on update
+        blacklist = Blacklist(MemoryClient(None), async=False)
+        blacklist.add('one', .1)
+        blacklist.add('two')
+        blacklist.add('three', .1)
+        blacklist.add('three', 10)
+        time.sleep(.2)
+        self.assertFalse('one' in blacklist)
+        self.assertTrue('two' in blacklist)
+        self.assertTrue('three' in blacklist)
+        self.assertEqual(len(blacklist), 3)
+
+        blacklist.update()
+        self.assertEqual(len(blacklist), 2)
+        self.assertTrue('two' in blacklist)
+        self.assertTrue('three' in blacklist)
+        self.assertTrue(blacklist._dirty)
+
+    def test_blacklist_any_ip(self):
+        # the blacklist works with any kind of address the middleware gets
+        blacklist = Blacklist(MemoryClient(None), async=False)
+        ips = ['10.0.0.1', '2001:db8::1', '::ffff:10.0.0.1', 'unknown']
+        for ip in ips:
+            blacklist.add(ip, 10)
+
+        for ip in ips:
+            self.assertTrue(ip in blacklist)
+
+        self.assertFalse('10.0.0.2' in blacklist)
+        self.assertFalse('2001:db8::2' in blacklist)
+
+    def test_blacklist_lookup_lock_free(self):
+        # looking up an IP should never wait on writers
+        blacklist = Blacklist(MemoryClient(None), async=False)
+        blacklist.add('one', 10)
+        blacklist.add('two')
+
+        class NoLock(object):
+            def acquire(self):
+                raise AssertionError('lookups should not lock')
+
+        blacklist._lock = NoLock()
+        self.assertFalse('three' in blacklist)
+        self.assertTrue('one' in blacklist)
+        self.assertTrue('two' in blacklist)
+
     def test_sync(self):
         app = IPFiltering(FakeApp(), queue_size=10, blacklist_ttl=.5,
                           treshold=5, br_queue_size=3,
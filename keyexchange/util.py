@@ -58,15 +58,18 @@ def generate_cid(size=4):
 class MemoryClient(dict):
     """Fallback if a memcache client is not installed.
     """
-    def __init__(self, servers):
+    def __init__(self, servers, **kw):
         pass
 
-    def set(self, key, value, time=0):
+    def set(self, key, value, time=0, min_compress_len=0):
         self[key] = value
         return True
 
     cas = set
 
+    def gets(self, key):
+        return self.get(key)
+
     def add(self, key, value, time=0):
         if key in self:
             return False